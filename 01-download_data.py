@@ -1,58 +1,72 @@
+import concurrent.futures
+import functools
+import hashlib
 import os
 import pathlib
+import uuid
 
-import pandas as pd
+import pyarrow.csv
+import pyarrow.parquet
+import requests
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery
+#the client library's own BQ-to-Arrow schema converter, needed for the
+#header of zero-row results where no batch carries the schema
+from google.cloud.bigquery import _pandas_helpers
+from google.cloud import bigquery_storage
+from google.cloud.bigquery_storage_v1.services.big_query_read.transports import BigQueryReadGrpcTransport
+from google.cloud import storage
+from google.api_core.exceptions import NotFound
 from google.oauth2 import service_account
 from dotenv import load_dotenv
 
 load_dotenv()
 #set paths for file navigation
-BASE_DIR = pathlib.Path().resolve().parent
+#anchored on this file so the data folders resolve the same no matter
+#which directory the script is launched from
+BASE_DIR = pathlib.Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR / 'data'
 RAW_DIR = DATA_DIR / 'raw'
 PROCESSED_DIR = DATA_DIR / 'processed'
 
-#load credentials for connecting to GCP
+#connection details for GCP, read from the .env file
 SERVICE_ACCOUNT_FILE = os.getenv('SERVICE_ACCOUNT_FILE')
 PROJECT_ID = os.getenv('PROJECT_ID')
-creds = service_account.Credentials.from_service_account_file(BASE_DIR / SERVICE_ACCOUNT_FILE)
+GCS_BUCKET = os.getenv('GCS_BUCKET')
+#set DEV_SAMPLE=1 to run the downloads on a 1% sample of the charges table,
+#for quick iteration without paying for full scans on every change
+CHARGES_SAMPLE = ' TABLESAMPLE SYSTEM (1 PERCENT)' if os.getenv('DEV_SAMPLE') else ''
 
-#instantiate BQ client
-client = bigquery.Client(credentials=creds, project=PROJECT_ID)
+DATASET = 'analytics-219613.toggl_take_home_data'
+SOURCE_CHARGES_TABLE = f'{DATASET}.monthly_charges_2021'
+CHARGES_TABLE = f'{DATASET}.monthly_charges_2021_agg'
+ORG_REVENUE_TABLE = f'{DATASET}.org_revenue_2021'
+CHURN_TABLE = f'{DATASET}.churn_numbers_2021'
 
 
-
-#functions to download datasets
-def get_monthly_charges_2021(target_file_name: str):
-    """
-    Connects to monthly_charges_2021 table on BQ, loads data into a pandas dataframe 
-    and writes to a csv file.
-       
-    Args:
-        target_file_name (str): Input the name you wish the generated CSV to take.
-    """
-    sql = """
-        SELECT *
-        FROM `analytics-219613.toggl_take_home_data.monthly_charges_2021`
-    """
-    
-    destination = RAW_DIR / target_file_name
-    df = client.query(sql).to_dataframe() 
-    df.to_csv(destination, index=False, header=True)
-    print(f'CSV file created. File name is {target_file_name} and location is {RAW_DIR}')
-    
-
-def get_orgs_before_2022(target_file_name: str):
+#query texts, one per dataset
+#kept at module level so the run_all dispatcher can fingerprint them
+#the charges column list is the set 02-EDA.ipynb actually reads
+MONTHLY_CHARGES_SQL = f"""
+        SELECT
+            id,
+            subscription_id,
+            organization_id,
+            charge_month,
+            charged_on,
+            plan,
+            type,
+            is_sales_driven,
+            billed_user_count,
+            amount_usd,
+            last_month_subscription_id,
+            last_month_billed_user_count,
+            last_month_amount_usd
+        FROM `{SOURCE_CHARGES_TABLE}`{CHARGES_SAMPLE}
     """
-    Connects to organizations_before_2022 table on BQ, loads relevant columns into a pandas dataframe 
-    and writes to a csv file.
 
-    Args:
-        target_file_name (str): Input the name you wish the generated CSV to take.
-    """
-    sql = """
-        SELECT 
+ORGS_BEFORE_2022_SQL = """
+        SELECT
             organization_id,
             organization_owner_id,
             created_at,
@@ -74,30 +88,14 @@ def get_orgs_before_2022(target_file_name: str):
             reported_annual_revenue
         FROM `analytics-219613.toggl_take_home_data.organizations_before_2022`
     """
-    
-    destination = RAW_DIR / target_file_name
-    df = client.query(sql).to_dataframe() 
-    df.to_csv(destination, index=False, header=True)
-    print(f'CSV file created. File name is {target_file_name} and location is {RAW_DIR}')
-    
-
-def get_paying_organizations(target_file_name: str):
-    """
-    Extracts the list of customers with more than 0 revenue from monthly_charges_2021
-    to a csv file.
 
-    Args:
-        target_file_name (str): Input the name you wish the generated CSV to take.
-    """
-    
-    sql = """
+PAYING_ORGANIZATIONS_SQL = f"""
         WITH nonzero_earners AS (
             SELECT
                 organization_id,
-                SUM(amount_usd) as total_revenue_2021
-            FROM `analytics-219613.toggl_take_home_data.monthly_charges_2021`
-            GROUP BY 1
-            HAVING SUM(amount_usd) > 0
+                total_revenue_2021
+            FROM `{ORG_REVENUE_TABLE}`
+            WHERE total_revenue_2021 > 0
         )
 
         SELECT
@@ -122,59 +120,22 @@ def get_paying_organizations(target_file_name: str):
         ON a.organization_id = b.organization_id
         ORDER BY 3 DESC
     """
-    
-    destination = PROCESSED_DIR / target_file_name
-    df = client.query(sql).to_dataframe() 
-    df.to_csv(destination, index=False, header=True)
-    print(f'CSV file created. File name is {target_file_name} and location is {PROCESSED_DIR}')
-    
-
-def get_churn_numbers(target_file_name: str):
-    """
-    Extracts list of customers, the number of times each one churned,
-    reactivated their subscription or was retained, and total revenue for 2021.
-
-    Args:
-        target_file_name (str): Input the name you wish the generated CSV to take.
-    """
-    
-    sql = """
-        SELECT
-            a.organization_id,
-            COUNT(CASE WHEN type = 'Churned' THEN 1 ELSE NULL END) as times_churned,
-            COUNT(CASE WHEN type = 'Reactivated' THEN 1 ELSE NULL END) as times_reactivated,
-            COUNT(CASE WHEN type = 'Retained' THEN 1 ELSE NULL END) as times_retained,
-            SUM(amount_usd) as revenue
-        FROM `analytics-219613.toggl_take_home_data.monthly_charges_2021` a
-        GROUP BY 1
-        ORDER BY 2 DESC, 3 ASC
-    """
-    
-    destination = PROCESSED_DIR / target_file_name
-    df = client.query(sql).to_dataframe() 
-    df.to_csv(destination, index=False, header=True)
-    print(f'CSV file created. File name is {target_file_name} and location is {PROCESSED_DIR}')
-    
 
-def get_outliers_and_mode(target_file_name: str):
+CHURN_NUMBERS_SQL = f"""
+        SELECT *
+        FROM `{CHURN_TABLE}`
+        ORDER BY times_churned DESC, times_reactivated ASC
     """
-    Extracts list of customers with earnings outside the outlier thresholds,
-    and within the mode range.
 
-    Args:
-        target_file_name (str): Input the name you wish the generated CSV to take.
-    """
-    
-    sql = """
+OUTLIERS_AND_MODE_SQL = f"""
         WITH outlier_earners AS (
             SELECT
                 organization_id,
-                SUM(amount_usd) as total_revenue_2021
-            FROM `analytics-219613.toggl_take_home_data.monthly_charges_2021`
-            GROUP BY 1
-            HAVING (
-                (SUM(amount_usd) > 22000) OR
-                (SUM(amount_usd) BETWEEN 90 AND 250)
+                total_revenue_2021
+            FROM `{ORG_REVENUE_TABLE}`
+            WHERE (
+                (total_revenue_2021 > 22000) OR
+                (total_revenue_2021 BETWEEN 90 AND 250)
             )
         )
 
@@ -200,105 +161,617 @@ def get_outliers_and_mode(target_file_name: str):
         ON a.organization_id = b.organization_id
         ORDER BY 2 DESC
     """
-    
-    destination = PROCESSED_DIR / target_file_name
-    df = client.query(sql).to_dataframe() 
-    df.to_csv(destination, index=False, header=True)
+
+GROUPBY_METRICS_SQL = f"""
+        SELECT
+            plan,
+            type,
+            quarter,
+            month,
+            GROUPING(plan) as plan_grouping,
+            GROUPING(type) as type_grouping,
+            COUNT(*) as num_charges,
+            COUNTIF(is_sales_driven) as num_sales_driven,
+            SUM(amount_usd) as revenue
+        FROM `{CHARGES_TABLE}`{CHARGES_SAMPLE}
+        GROUP BY GROUPING SETS ((plan, quarter, month), (type, quarter, month))
+    """
+
+
+#client factories
+#the clients are created lazily on first use and cached, so importing the
+#module does not pay for credential file reads and JWT signing, and every
+#function shares the same connections
+@functools.lru_cache(maxsize=1)
+def _creds():
+    """Loads the service account credentials on first use."""
+    return service_account.Credentials.from_service_account_file(BASE_DIR / SERVICE_ACCOUNT_FILE)
+
+
+@functools.lru_cache(maxsize=1)
+def _http_session():
+    """
+    One authorized HTTP session with a connection pool sized for all the
+    concurrent downloads, so the parallel queries reuse keep-alive
+    connections instead of each paying for a TLS handshake.
+    """
+    session = AuthorizedSession(_creds())
+    adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount('https://', adapter)
+    return session
+
+
+@functools.lru_cache(maxsize=1)
+def _client():
+    """Creates the BigQuery client on first use."""
+    #cache results by query text so re-running unchanged SQL is free
+    default_query_config = bigquery.QueryJobConfig(use_query_cache=True, use_legacy_sql=False)
+    return bigquery.Client(
+        credentials=_creds(),
+        project=PROJECT_ID,
+        _http=_http_session(),
+        default_query_job_config=default_query_config,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _bqs_client():
+    """
+    Creates the BigQuery Storage read client on first use. It streams query
+    results as parallel Arrow batches over gRPC, which is much faster than
+    the default REST download path. All the downloads share this one client,
+    so its long-lived HTTP/2 channel is set up (and its TLS handshake paid)
+    exactly once, with room for large Arrow batches to arrive unfragmented.
+    """
+    channel = BigQueryReadGrpcTransport.create_channel(
+        credentials=_creds(),
+        options=[('grpc.max_receive_message_length', 128 * 1024 * 1024)],
+    )
+    return bigquery_storage.BigQueryReadClient(transport=BigQueryReadGrpcTransport(channel=channel))
+
+
+@functools.lru_cache(maxsize=1)
+def _storage_client():
+    """Creates the GCS client on first use."""
+    return storage.Client(credentials=_creds(), project=PROJECT_ID)
+
+
+def create_monthly_charges_agg():
+    """
+    One-time setup: materializes monthly_charges_2021 into a clustered table
+    with the charge month and quarter precomputed. All the download queries
+    that use the charges read from this table, so BigQuery can prune down to
+    the columns and clusters each one needs instead of rescanning the raw
+    table six times over.
+    """
+    sql = f"""
+        CREATE OR REPLACE TABLE `{CHARGES_TABLE}`
+        PARTITION BY DATE_TRUNC(charged_on, MONTH)
+        CLUSTER BY organization_id, plan, type, month
+        AS
+        SELECT
+            organization_id,
+            plan,
+            type,
+            charged_on,
+            EXTRACT(QUARTER FROM charged_on) as quarter,
+            EXTRACT(MONTH FROM charged_on) as month,
+            is_sales_driven,
+            amount_usd
+        FROM `{SOURCE_CHARGES_TABLE}`
+    """
+    _client().query(sql).result()
+    print(f'Created clustered charges table {CHARGES_TABLE}')
+
+
+def create_org_revenue_table():
+    """
+    One-time setup: stores each organization's total 2021 revenue in a small
+    persistent table. The paying organizations and outlier queries both need
+    this sum, so computing it once keeps the shared work out of both.
+    """
+    sql = f"""
+        CREATE OR REPLACE TABLE `{ORG_REVENUE_TABLE}`
+        AS
+        SELECT
+            organization_id,
+            SUM(amount_usd) as total_revenue_2021
+        FROM `{CHARGES_TABLE}`
+        GROUP BY 1
+    """
+    _client().query(sql).result()
+    print(f'Created org revenue table {ORG_REVENUE_TABLE}')
+
+
+def create_churn_numbers_table():
+    """
+    One-time setup: persists the per-organization churn counts so downstream
+    analyses can reuse them instead of recomputing the aggregation.
+    """
+    sql = f"""
+        CREATE OR REPLACE TABLE `{CHURN_TABLE}`
+        AS
+        SELECT
+            organization_id,
+            COUNTIF(type = 'Churned') as times_churned,
+            COUNTIF(type = 'Reactivated') as times_reactivated,
+            COUNTIF(type = 'Retained') as times_retained,
+            SUM(amount_usd) as revenue
+        FROM `{CHARGES_TABLE}`
+        GROUP BY 1
+    """
+    _client().query(sql).result()
+    print(f'Created churn numbers table {CHURN_TABLE}')
+
+
+def _ensure_charges_table():
+    """Creates the clustered charges table if it does not exist yet."""
+    try:
+        _client().get_table(CHARGES_TABLE)
+    except NotFound:
+        create_monthly_charges_agg()
+
+
+def _ensure_org_revenue_table():
+    """Creates the per-organization revenue table if it does not exist yet."""
+    try:
+        _client().get_table(ORG_REVENUE_TABLE)
+    except NotFound:
+        _ensure_charges_table()
+        create_org_revenue_table()
+
+
+def _ensure_churn_numbers_table():
+    """Creates the churn numbers table if it does not exist yet."""
+    try:
+        _client().get_table(CHURN_TABLE)
+    except NotFound:
+        _ensure_charges_table()
+        create_churn_numbers_table()
+
+
+#helpers shared by the download functions
+def _submit_export(sql):
+    """
+    Submits a full table export query and returns the QueryJob without
+    waiting for it. When GCS_BUCKET is set in the .env file, the job writes
+    into a temporary table so the result can be extracted to GCS afterwards.
+
+    Args:
+        sql (str): The query whose result should be exported.
+    """
+    #batch priority keeps the long-running exports out of the interactive
+    #slot queue, so they don't contend with the short aggregate queries
+    if GCS_BUCKET:
+        tmp_table = f'{DATASET}.tmp_extract_{uuid.uuid4().hex}'
+        job_config = bigquery.QueryJobConfig(
+            destination=tmp_table,
+            allow_large_results=True,
+            priority=bigquery.QueryPriority.BATCH,
+        )
+    else:
+        job_config = bigquery.QueryJobConfig(priority=bigquery.QueryPriority.BATCH)
+    return _client().query(sql, job_config=job_config)
+
+
+def _extract_job_to_csv(job, target_file_name, destination):
+    """
+    Waits for a query job started by _submit_export, has BigQuery extract its
+    temporary table to GCS as gzipped CSV, and downloads the single result
+    file. This keeps the CSV encoding on BigQuery's parallel workers instead
+    of doing it on the local machine, which is much faster for the full
+    table downloads. Requires GCS_BUCKET to be set in the .env file.
+
+    Args:
+        job (QueryJob): A job returned by _submit_export.
+        target_file_name (str): Name of the local gzipped CSV to create.
+        destination (pathlib.Path): Full local path to download to.
+    """
+    job.result()
+
+    #the temporary table is deleted even when the extract fails, and the
+    #exported GCS object is removed once it has been downloaded
+    try:
+        extract_config = bigquery.ExtractJobConfig(compression='GZIP')
+        _client().extract_table(job.destination, f'gs://{GCS_BUCKET}/{target_file_name}', job_config=extract_config).result()
+    finally:
+        _client().delete_table(job.destination, not_found_ok=True)
+
+    blob = _storage_client().bucket(GCS_BUCKET).blob(target_file_name)
+    blob.download_to_filename(destination)
+    blob.delete()
+
+
+def _open_writer(name, schema, streams):
+    """
+    Opens the Arrow writer for a destination file, picking the format from
+    the extension. A 1 MiB buffer batches the syscalls, so each writer
+    issues a few large write() calls instead of many small ones while the
+    seven downloads run concurrently. Raw streams opened along the way are
+    appended to streams so the caller can close them after the writer.
+
+    Args:
+        name (str): Full local path of the file to create.
+        schema (pyarrow.Schema): Schema of the batches to be written.
+        streams (list): Receives the opened streams, outermost last.
+    """
+    if name.endswith('.parquet'):
+        return pyarrow.parquet.ParquetWriter(name, schema, compression='snappy')
+
+    #compression=None stops output_stream from detecting the .gz suffix
+    #and gzipping on top of the explicit layer
+    out_stream = pyarrow.output_stream(name, compression=None, buffer_size=1 << 20)
+    streams.append(out_stream)
+    if name.endswith('.gz'):
+        out_stream = pyarrow.CompressedOutputStream(out_stream, 'gzip')
+        streams.append(out_stream)
+
+    return pyarrow.csv.CSVWriter(out_stream, schema)
+
+
+def _finish_job_to_file(job, destination):
+    """
+    Waits for a query job and streams its result into a local file one Arrow
+    record batch at a time. Peak memory stays at a single batch instead of
+    the whole result set, and writing overlaps the network download. The
+    format follows the file name: .parquet gets snappy-compressed Parquet,
+    .gz gets gzipped CSV, anything else a plain CSV.
+
+    Args:
+        job (QueryJob): A previously submitted query job.
+        destination (pathlib.Path): Full local path of the file to create.
+    """
+    rows = job.result(page_size=100_000)
+    name = str(destination)
+
+    writer = None
+    streams = []
+    try:
+        for batch in rows.to_arrow_iterable(bqstorage_client=_bqs_client()):
+            if writer is None:
+                #the header/schema is written once, from the first batch
+                writer = _open_writer(name, batch.schema, streams)
+            if isinstance(writer, pyarrow.parquet.ParquetWriter):
+                writer.write_table(pyarrow.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+        if writer is None:
+            #a zero-row result yields no batches, so convert the result
+            #schema and let the close below write the header-only file
+            writer = _open_writer(name, _pandas_helpers.bq_to_arrow_schema(rows.schema), streams)
+    finally:
+        if writer is not None:
+            writer.close()
+        for stream in reversed(streams):
+            stream.close()
+
+
+def _write_table(table, destination):
+    """
+    Writes an Arrow table to the destination, picking the format from the
+    file name the same way _finish_job_to_file does.
+
+    Args:
+        table (pyarrow.Table): The data to write.
+        destination (pathlib.Path): Full local path of the file to create.
+    """
+    name = str(destination)
+    if name.endswith('.parquet'):
+        pyarrow.parquet.write_table(table, name, compression='snappy')
+    elif name.endswith('.gz'):
+        #compression=None stops output_stream from detecting the .gz suffix
+        #and gzipping on top of the explicit layer
+        with pyarrow.output_stream(name, compression=None, buffer_size=1 << 20) as raw_stream:
+            with pyarrow.CompressedOutputStream(raw_stream, 'gzip') as out_stream:
+                pyarrow.csv.write_csv(table, out_stream)
+    else:
+        with pyarrow.output_stream(name, buffer_size=1 << 20) as out_stream:
+            pyarrow.csv.write_csv(table, out_stream)
+
+
+def _sql_digest(sql):
+    """Returns the sha256 fingerprint of a query text."""
+    return hashlib.sha256(sql.encode()).hexdigest()
+
+
+def _is_fresh(sql, destination):
+    """
+    True when the output file already exists and the .sha256 sidecar next to
+    it matches the SQL that would produce it, meaning the query has not
+    changed since the file was written and the download can be skipped. A
+    local analog of BigQuery's query result cache.
+
+    Args:
+        sql (str): The query text for the output.
+        destination (pathlib.Path): Full local path of the output file.
+    """
+    marker = pathlib.Path(f'{destination}.sha256')
+    return destination.exists() and marker.exists() and marker.read_text() == _sql_digest(sql)
+
+
+def _mark_fresh(sql, destination):
+    """Records the SQL fingerprint next to a freshly written output file."""
+    pathlib.Path(f'{destination}.sha256').write_text(_sql_digest(sql))
+
+
+#functions to download datasets
+#each submit_* starts the query on BQ and returns immediately; the matching
+#get_* waits for the job and writes the csv, submitting first if needed
+#the small aggregate queries go through the jobs.query API so the first page
+#of results comes back with the initial request instead of two extra calls
+def submit_monthly_charges_2021():
+    """
+    Starts the monthly_charges_2021 download query on BQ and returns the
+    QueryJob without waiting for it. The raw export reads the source table
+    directly; the aggregate queries are the ones served by the clustered
+    copy.
+    """
+    return _submit_export(MONTHLY_CHARGES_SQL)
+
+
+def get_monthly_charges_2021(target_file_name: str, job=None):
+    """
+    Connects to monthly_charges_2021 table on BQ, downloads the data
+    and writes to a csv file.
+
+    Args:
+        target_file_name (str): Input the name you wish the generated CSV to take.
+        job (QueryJob, optional): An already running job from
+            submit_monthly_charges_2021, used by run_all.
+    """
+    if job is None:
+        job = submit_monthly_charges_2021()
+
+    if GCS_BUCKET:
+        if not target_file_name.endswith('.gz'):
+            target_file_name = f'{target_file_name}.gz'
+        _extract_job_to_csv(job, target_file_name, RAW_DIR / target_file_name)
+    else:
+        _finish_job_to_file(job, RAW_DIR / target_file_name)
+    print(f'CSV file created. File name is {target_file_name} and location is {RAW_DIR}')
+
+
+def submit_orgs_before_2022():
+    """
+    Starts the organizations_before_2022 download query on BQ and returns the
+    QueryJob without waiting for it.
+    """
+    return _submit_export(ORGS_BEFORE_2022_SQL)
+
+
+def get_orgs_before_2022(target_file_name: str, job=None):
+    """
+    Connects to organizations_before_2022 table on BQ, downloads the relevant columns
+    and writes to a csv file.
+
+    Args:
+        target_file_name (str): Input the name you wish the generated CSV to take.
+        job (QueryJob, optional): An already running job from
+            submit_orgs_before_2022, used by run_all.
+    """
+    if job is None:
+        job = submit_orgs_before_2022()
+
+    if GCS_BUCKET:
+        if not target_file_name.endswith('.gz'):
+            target_file_name = f'{target_file_name}.gz'
+        _extract_job_to_csv(job, target_file_name, RAW_DIR / target_file_name)
+    else:
+        _finish_job_to_file(job, RAW_DIR / target_file_name)
+    print(f'CSV file created. File name is {target_file_name} and location is {RAW_DIR}')
+
+
+def submit_paying_organizations():
+    """
+    Starts the paying organizations query on BQ and returns the QueryJob
+    without waiting for it.
+    """
+    _ensure_org_revenue_table()
+
+    return _client().query(PAYING_ORGANIZATIONS_SQL, api_method=bigquery.enums.QueryApiMethod.QUERY)
+
+
+def get_paying_organizations(target_file_name: str, job=None):
+    """
+    Extracts the list of customers with more than 0 revenue from monthly_charges_2021
+    to a csv file.
+
+    Args:
+        target_file_name (str): Input the name you wish the generated CSV to take.
+        job (QueryJob, optional): An already running job from
+            submit_paying_organizations, used by run_all.
+    """
+    if job is None:
+        job = submit_paying_organizations()
+
+    _finish_job_to_file(job, PROCESSED_DIR / target_file_name)
     print(f'CSV file created. File name is {target_file_name} and location is {PROCESSED_DIR}')
-    
 
-def get_groupby_plan(target_file_name: str):
+
+def submit_churn_numbers():
     """
-    Extracts counts of various metrics, grouped by plan, month, and quarter.
+    Starts the churn numbers query on BQ and returns the QueryJob without
+    waiting for it.
+    """
+    _ensure_churn_numbers_table()
+
+    return _client().query(CHURN_NUMBERS_SQL, api_method=bigquery.enums.QueryApiMethod.QUERY)
+
+
+def get_churn_numbers(target_file_name: str, job=None):
+    """
+    Extracts list of customers, the number of times each one churned,
+    reactivated their subscription or was retained, and total revenue for 2021.
 
     Args:
         target_file_name (str): Input the name you wish the generated CSV to take.
+        job (QueryJob, optional): An already running job from
+            submit_churn_numbers, used by run_all.
     """
-    
-    sql = """
-        WITH groupedby_plans AS (
-            SELECT
-                plan,
-                EXTRACT(QUARTER FROM charged_on) as quarter,
-                EXTRACT(MONTH FROM charged_on) as month,
-                COUNT(*) as num_charges,
-                SUM(CASE WHEN is_sales_driven = True THEN 1 ELSE 0 END) as num_sales_driven,
-                SUM(amount_usd) as revenue
-            FROM `analytics-219613.toggl_take_home_data.monthly_charges_2021`
-            GROUP BY 1,2,3 
-            ORDER BY 1,2,3
-        )
+    if job is None:
+        job = submit_churn_numbers()
 
+    _finish_job_to_file(job, PROCESSED_DIR / target_file_name)
+    print(f'CSV file created. File name is {target_file_name} and location is {PROCESSED_DIR}')
 
-        SELECT
-            plan,
-            month,
-            quarter,
-            SUM(num_charges) OVER (PARTITION BY plan, month) as monthly_count,
-            SUM(num_charges) OVER (PARTITION BY plan, quarter) as qtr_count,
-            SUM(num_charges) OVER (PARTITION BY plan) as count_by_plan,
-            SUM(num_charges) OVER () as total_count,
-            SUM(num_sales_driven) OVER (PARTITION BY plan, month) as monthly_sales_driven,
-            SUM(num_sales_driven) OVER (PARTITION BY plan, quarter) as qtr_sales_driven,
-            SUM(num_sales_driven) OVER (PARTITION BY plan) as sales_driven_by_plan,
-            SUM(num_sales_driven) OVER () as total_sales_driven,
-            SUM(revenue) OVER (PARTITION BY plan, month) as monthly_revenue,
-            SUM(revenue) OVER (PARTITION BY plan, quarter) as qtr_revenue,
-            SUM(revenue) OVER (PARTITION BY plan) as revenue_by_plan,
-            SUM(revenue) OVER () as total_revenue
-        FROM groupedby_plans
-        ORDER BY 1,2,3
-    """
-    
-    destination = PROCESSED_DIR / target_file_name
-    df = client.query(sql).to_dataframe() 
-    df.to_csv(destination, index=False, header=True)
+
+def submit_outliers_and_mode():
+    """
+    Starts the outliers and mode query on BQ and returns the QueryJob without
+    waiting for it.
+    """
+    _ensure_org_revenue_table()
+
+    return _client().query(OUTLIERS_AND_MODE_SQL, api_method=bigquery.enums.QueryApiMethod.QUERY)
+
+
+def get_outliers_and_mode(target_file_name: str, job=None):
+    """
+    Extracts list of customers with earnings outside the outlier thresholds,
+    and within the mode range.
+
+    Args:
+        target_file_name (str): Input the name you wish the generated CSV to take.
+        job (QueryJob, optional): An already running job from
+            submit_outliers_and_mode, used by run_all.
+    """
+    if job is None:
+        job = submit_outliers_and_mode()
+
+    _finish_job_to_file(job, PROCESSED_DIR / target_file_name)
     print(f'CSV file created. File name is {target_file_name} and location is {PROCESSED_DIR}')
-    
 
-def get_groupby_type(target_file_name: str):
+
+def submit_groupby_metrics():
+    """
+    Starts the fused groupby query on BQ and returns the QueryJob without
+    waiting for it. GROUPING SETS produces the per-plan and per-type
+    breakdowns in a single scan, so one job feeds both get_groupby_plan
+    and get_groupby_type.
+    """
+    _ensure_charges_table()
+
+    return _client().query(GROUPBY_METRICS_SQL, api_method=bigquery.enums.QueryApiMethod.QUERY)
+
+
+def _finish_groupby_csv(job, group_col, destination):
+    """
+    Waits for the fused groupby query, keeps the rows belonging to the given
+    grouping column (plan or type), adds the rolled up totals and writes the
+    csv. The grouped result is only a few dozen rows, so summing the rollup
+    columns locally is far cheaper than running them as window passes on
+    BigQuery.
+
+    Args:
+        job (QueryJob): A job from submit_groupby_metrics.
+        group_col (str): 'plan' or 'type', the grouping set to keep.
+        destination (pathlib.Path): Full local path of the CSV to create.
+    """
+    other_col = 'type' if group_col == 'plan' else 'plan'
+    #dtype_backend='pyarrow' needs a newer pandas than the pinned one, so
+    #convert from Arrow with split blocks instead of one consolidated copy
+    df = job.result().to_arrow().to_pandas(split_blocks=True, self_destruct=True)
+    #GROUPING() is 0 on the rows where the column was part of the grouping
+    #set, so genuinely NULL plan or type values are kept in their own group
+    df = df[df[f'{group_col}_grouping'] == 0]
+    df = df.drop(columns=[other_col, 'plan_grouping', 'type_grouping'])
+
+    out = df[[group_col, 'month', 'quarter']].copy()
+    rollups = {
+        'num_charges': ('monthly_count', 'qtr_count', f'count_by_{group_col}', 'total_count'),
+        'num_sales_driven': ('monthly_sales_driven', 'qtr_sales_driven', f'sales_driven_by_{group_col}', 'total_sales_driven'),
+        'revenue': ('monthly_revenue', 'qtr_revenue', f'revenue_by_{group_col}', 'total_revenue'),
+    }
+    #dropna=False keeps a NULL plan or type as an ordinary group, matching
+    #how a SQL PARTITION BY treats NULL partitions
+    for metric, (monthly, qtr, by_group, total) in rollups.items():
+        out[monthly] = df.groupby([group_col, 'month'], dropna=False)[metric].transform('sum')
+        out[qtr] = df.groupby([group_col, 'quarter'], dropna=False)[metric].transform('sum')
+        out[by_group] = df.groupby(group_col, dropna=False)[metric].transform('sum')
+        out[total] = df[metric].sum()
+
+    out = out.sort_values([group_col, 'month', 'quarter'])
+    _write_table(pyarrow.Table.from_pandas(out, preserve_index=False), destination)
+
+
+def get_groupby_plan(target_file_name: str, job=None):
+    """
+    Extracts counts of various metrics, grouped by plan, month, and quarter.
+
+    Args:
+        target_file_name (str): Input the name you wish the generated CSV to take.
+        job (QueryJob, optional): An already running job from
+            submit_groupby_metrics, used by run_all.
+    """
+    if job is None:
+        job = submit_groupby_metrics()
+
+    _finish_groupby_csv(job, 'plan', PROCESSED_DIR / target_file_name)
+    print(f'CSV file created. File name is {target_file_name} and location is {PROCESSED_DIR}')
+
+
+def get_groupby_type(target_file_name: str, job=None):
     """
     Extracts counts of various metrics, grouped by charge type, month, and quarter.
 
     Args:
         target_file_name (str): Input the name you wish the generated CSV to take.
+        job (QueryJob, optional): An already running job from
+            submit_groupby_metrics, used by run_all.
     """
-    
-    sql = """
-        WITH groupedby_types AS (
-            SELECT
-                type,
-                EXTRACT(QUARTER FROM charged_on) as quarter,
-                EXTRACT(MONTH FROM charged_on) as month,
-                COUNT(*) as num_charges,
-                SUM(CASE WHEN is_sales_driven = True THEN 1 ELSE 0 END) as num_sales_driven,
-                SUM(amount_usd) as revenue
-            FROM `analytics-219613.toggl_take_home_data.monthly_charges_2021`
-            GROUP BY 1,2,3 
-            ORDER BY 1,2,3
-        )
+    if job is None:
+        job = submit_groupby_metrics()
 
-        SELECT
-            type,
-            month,
-            quarter,
-            SUM(num_charges) OVER (PARTITION BY type, month) as monthly_count,
-            SUM(num_charges) OVER (PARTITION BY type, quarter) as qtr_count,
-            SUM(num_charges) OVER (PARTITION BY type) as count_by_type,
-            SUM(num_charges) OVER () as total_count,
-            SUM(num_sales_driven) OVER (PARTITION BY type, month) as monthly_sales_driven,
-            SUM(num_sales_driven) OVER (PARTITION BY type, quarter) as qtr_sales_driven,
-            SUM(num_sales_driven) OVER (PARTITION BY type) as sales_driven_by_type,
-            SUM(num_sales_driven) OVER () as total_sales_driven,
-            SUM(revenue) OVER (PARTITION BY type, month) as monthly_revenue,
-            SUM(revenue) OVER (PARTITION BY type, quarter) as qtr_revenue,
-            SUM(revenue) OVER (PARTITION BY type) as revenue_by_type,
-            SUM(revenue) OVER () as total_revenue
-        FROM groupedby_types
-        ORDER BY 1,2,3
-    """
-    
-    destination = PROCESSED_DIR / target_file_name
-    df = client.query(sql).to_dataframe() 
-    df.to_csv(destination, index=False, header=True)
-    print(f'CSV file created. File name is {target_file_name} and location is {PROCESSED_DIR}')
\ No newline at end of file
+    _finish_groupby_csv(job, 'type', PROCESSED_DIR / target_file_name)
+    print(f'CSV file created. File name is {target_file_name} and location is {PROCESSED_DIR}')
+
+
+#the dispatcher table: one row per output file
+#the fused groupby query appears twice but is submitted only once, because
+#run_all keys the submitted jobs by their SQL text
+JOBS = [
+    (submit_monthly_charges_2021, MONTHLY_CHARGES_SQL, get_monthly_charges_2021, RAW_DIR, 'monthly_charges_2021.csv.gz'),
+    (submit_orgs_before_2022, ORGS_BEFORE_2022_SQL, get_orgs_before_2022, RAW_DIR, 'organizations_before_2022.csv.gz'),
+    (submit_paying_organizations, PAYING_ORGANIZATIONS_SQL, get_paying_organizations, PROCESSED_DIR, 'paying_organizations.csv'),
+    (submit_churn_numbers, CHURN_NUMBERS_SQL, get_churn_numbers, PROCESSED_DIR, 'churn_numbers.csv'),
+    (submit_outliers_and_mode, OUTLIERS_AND_MODE_SQL, get_outliers_and_mode, PROCESSED_DIR, 'outliers_and_mode.csv'),
+    (submit_groupby_metrics, GROUPBY_METRICS_SQL, get_groupby_plan, PROCESSED_DIR, 'groupby_plan.csv'),
+    (submit_groupby_metrics, GROUPBY_METRICS_SQL, get_groupby_type, PROCESSED_DIR, 'groupby_type.csv'),
+]
+
+
+def run_all():
+    """
+    Works through the JOBS table: submits every query to BQ at once and
+    downloads the results on parallel threads, so the total wall time is
+    close to the slowest single query instead of the sum of all of them.
+    Outputs whose sidecar fingerprint still matches their SQL are skipped
+    without re-querying or re-downloading.
+    """
+    pending = []
+    jobs_by_sql = {}
+    for submit, sql, get, directory, file_name in JOBS:
+        destination = directory / file_name
+        if _is_fresh(sql, destination):
+            print(f'Skipping {file_name}, output is up to date.')
+            continue
+        #submit everything first so all queries are running before we start
+        #waiting; identical SQL is only submitted once
+        if sql not in jobs_by_sql:
+            jobs_by_sql[sql] = submit()
+        pending.append((get, jobs_by_sql[sql], sql, destination, file_name))
+
+    if not pending:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(pending)) as pool:
+        futures = {
+            pool.submit(get, file_name, job=job): (sql, destination)
+            for get, job, sql, destination, file_name in pending
+        }
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            _mark_fresh(*futures[future])
+
+
+if __name__ == '__main__':
+    run_all()